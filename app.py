@@ -1,42 +1,79 @@
-import os, json, uuid, threading, pickle
+import os, json, uuid, threading, pickle, time, random, hashlib
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from typing import Dict, List
 
-from flask import Flask, request, jsonify, render_template, session
+from flask import Flask, Response, request, jsonify, render_template, session, g, has_request_context
 from werkzeug.utils import secure_filename
 import openai
 from dotenv import load_dotenv
 load_dotenv()
 
-from PyPDF2 import PdfReader
-from pdfminer.high_level import extract_text as pdfminer_text
-import fitz
-import docx
-import pandas as pd
+import extract
 
 import numpy as np
-from sqlalchemy import create_engine, Column, Integer, String, LargeBinary
+import tiktoken
+import click
+from sqlalchemy import insert, delete, select, func, text, bindparam, inspect, event, create_engine, Column, Integer, String, LargeBinary, Float
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.exc import OperationalError
 from werkzeug.exceptions import HTTPException
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "dev-secret")
-LOCK = threading.Lock()
+LOCK = threading.RLock()
 
 BASE_DIR     = os.path.abspath(os.path.dirname(__file__))
-UPLOAD_DIR   = os.path.join(BASE_DIR, "faq_uploads")
+DATA_DIR     = os.path.abspath(os.getenv("DATA_DIR", BASE_DIR))
+UPLOAD_DIR   = os.path.join(DATA_DIR, "faq_uploads")
 INDEX_FILE   = os.path.join(UPLOAD_DIR, "_index.json")
-PERSONA_FILE = os.path.join(BASE_DIR, "personas.json")
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+PERSONA_FILE = os.path.join(DATA_DIR, "personas.json")
 
 EMBED_MODEL = "text-embedding-3-small"
 EMBED_COST_PER_KTOKENS = 0.0001
 MAX_TOKENS_PER_CHUNK = 8192
 MAX_CHARS_PER_CHUNK = 12000
+ENCODER_RETRY_SECONDS = 60
+EMBED_STORAGE = os.getenv("EMBED_STORAGE", "float32")
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "100000"))
+EMBED_BATCH_INPUTS = int(os.getenv("EMBED_BATCH_INPUTS", "512"))
+EMBED_WORKERS      = int(os.getenv("EMBED_WORKERS", "4"))
+EMBED_RETRIES      = int(os.getenv("EMBED_RETRIES", "5"))
+INGEST_WORKERS     = int(os.getenv("INGEST_WORKERS", "2"))
+JOB_TTL_SECONDS    = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+EXTRACT_WORKERS    = int(os.getenv("EXTRACT_WORKERS", str(os.cpu_count() or 2)))
+PDF_MAX_PAGES       = int(os.getenv("PDF_MAX_PAGES", "10"))
+DOCX_MAX_PARAGRAPHS = int(os.getenv("DOCX_MAX_PARAGRAPHS", "300"))
+CACHE_STAT_SECONDS = float(os.getenv("CACHE_STAT_SECONDS", "2"))
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "4000"))
+PROMPT_FAQ_TOKENS   = int(os.getenv("PROMPT_FAQ_TOKENS", "1500"))
+SUMMARY_TURN_TOKENS = int(os.getenv("SUMMARY_TURN_TOKENS", "40"))
+MAX_HISTORY_MESSAGES = int(os.getenv("MAX_HISTORY_MESSAGES", "50"))
+HISTORY_BACKEND      = os.getenv("HISTORY_BACKEND", "memory")
+HISTORY_DB           = os.getenv("HISTORY_DB", os.path.join(DATA_DIR, "chat_history.db"))
+HISTORY_MAX_SESSIONS = int(os.getenv("HISTORY_MAX_SESSIONS", "10000"))
+HISTORY_TTL_SECONDS  = int(os.getenv("HISTORY_TTL_SECONDS", "86400"))
+QUERY_CACHE_SIZE       = int(os.getenv("QUERY_CACHE_SIZE", "2048"))
+ANSWER_CACHE_ENABLED   = os.getenv("ANSWER_CACHE_ENABLED", "0") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.97"))
+ANSWER_CACHE_SIZE      = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL       = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
+EMBED_RETRY_ERRORS = (openai.RateLimitError, openai.APIConnectionError,
+                      openai.APITimeoutError, openai.InternalServerError)
 
-ENG     = create_engine(f"sqlite:///{os.path.join(BASE_DIR,'faq_chunks.db')}")
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "ivf")
+IVF_MIN_ROWS   = int(os.getenv("IVF_MIN_ROWS", "20000"))
+IVF_NPROBE     = int(os.getenv("IVF_NPROBE", "8"))
+
+METRICS_TOKEN  = os.getenv("METRICS_TOKEN")
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+ENG     = create_engine(f"sqlite:///{os.path.join(DATA_DIR,'faq_chunks.db')}")
 Base    = declarative_base()
 Session = sessionmaker(bind=ENG)
 
@@ -46,8 +83,123 @@ class Chunk(Base):
     file_id = Column(String, index=True)
     text    = Column(String)
     emb     = Column(LargeBinary)
+    emb_dtype = Column(String)
+    emb_scale = Column(Float)
+    hash      = Column(String, index=True)
+
+def create_tables(metadata, engine):
+    """create_all that tolerates another worker creating the same tables at the same time."""
+    try:
+        metadata.create_all(engine)
+    except OperationalError as e:
+        if "already exists" not in str(e): raise
+        metadata.create_all(engine)
+
+def ensure_columns():
+    """Add columns newer than an existing chunks table. Workers booting together may both
+    try; the loser's "duplicate column" error is ignored."""
+    have = {c["name"] for c in inspect(ENG).get_columns("chunks")}
+    for name, sql_type in (("emb_dtype", "VARCHAR"), ("emb_scale", "FLOAT"), ("hash", "VARCHAR")):
+        if name in have: continue
+        try:
+            with ENG.begin() as conn: conn.execute(text(f"ALTER TABLE chunks ADD COLUMN {name} {sql_type}"))
+        except OperationalError as e:
+            if "duplicate column" not in str(e): raise
+    with ENG.begin() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_chunks_hash ON chunks (hash)"))
+
+def encode_emb(vec, dtype=EMBED_STORAGE):
+    vec = np.asarray(vec, dtype="float32")
+    if dtype == "int8":
+        scale = float(np.abs(vec).max()) / 127 or 1.0
+        return np.round(vec / scale).astype(np.int8).tobytes(), scale
+    return vec.astype(dtype).tobytes(), None
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def file_sha256(path, block=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for buf in iter(lambda: f.read(block), b""): h.update(buf)
+    return h.hexdigest()
+
+class Histogram:
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.counts  = [0] * (len(buckets) + 1)
+        self.sum = self.count = 0
+
+    def observe(self, value):
+        i = next((i for i, b in enumerate(self.buckets) if value <= b), len(self.buckets))
+        self.counts[i] += 1
+        self.sum   += value
+        self.count += 1
+
+    def quantile(self, q):
+        if not self.count: return None
+        seen = 0
+        for b, n in zip(self.buckets + ("+Inf",), self.counts):
+            seen += n
+            if seen >= q * self.count: return b
+
+    def to_dict(self):
+        return {
+            "count": self.count, "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else None,
+            "p50": self.quantile(0.5), "p95": self.quantile(0.95), "p99": self.quantile(0.99),
+            "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], self.counts)),
+        }
 
-Base.metadata.create_all(ENG)
+class Metrics:
+    """Process-local stage timers (histograms, in seconds) and counters."""
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.histograms = defaultdict(Histogram)
+        self.counters   = defaultdict(float)
+
+    def observe(self, name, seconds):
+        with self.lock: self.histograms[name].observe(seconds)
+
+    def inc(self, name, n=1):
+        with self.lock: self.counters[name] += n
+
+    def snapshot(self):
+        with self.lock:
+            return {"stages": {k: h.to_dict() for k, h in sorted(self.histograms.items())},
+                    "counters": dict(sorted(self.counters.items()))}
+
+    def prometheus(self):
+        lines = ["# TYPE chatbot_stage_seconds histogram"]
+        with self.lock:
+            for name, h in sorted(self.histograms.items()):
+                cum = 0
+                for b, n in zip([str(b) for b in h.buckets] + ["+Inf"], h.counts):
+                    cum += n
+                    lines.append(f'chatbot_stage_seconds_bucket{{stage="{name}",le="{b}"}} {cum}')
+                lines.append(f'chatbot_stage_seconds_sum{{stage="{name}"}} {h.sum}')
+                lines.append(f'chatbot_stage_seconds_count{{stage="{name}"}} {h.count}')
+            for name, v in sorted(self.counters.items()):
+                lines += [f"# TYPE chatbot_{name}_total counter", f"chatbot_{name}_total {v}"]
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+METRICS = Metrics()
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        METRICS.observe(stage, elapsed)
+        if has_request_context() and "timings" in g:
+            g.timings[stage] = g.timings.get(stage, 0) + elapsed
 
 def handle_db(fn):
     def wrapped(*a, **kw):
@@ -56,148 +208,1031 @@ def handle_db(fn):
         finally: sess.close()
     return wrapped
 
+EMBED_POOL = None  # created by init_app
+
+ENCODERS = {}
+
+def encoder(model=EMBED_MODEL):
+    """The tiktoken encoding for `model` (cl100k_base for models tiktoken does not know),
+    or None while it cannot be loaded.
+
+    A failed load (usually fetching the BPE file) is retried after ENCODER_RETRY_SECONDS
+    instead of leaving the process on the chars/4 estimate for good.
+    """
+    enc, failed = ENCODERS.get(model, (None, None))
+    if enc is not None or (failed and time.monotonic() - failed < ENCODER_RETRY_SECONDS): return enc
+    try:
+        try: enc = tiktoken.encoding_for_model(model)
+        except KeyError: enc = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print("Tokenizer unavailable, estimating tokens:", e)
+        ENCODERS[model] = (None, time.monotonic())
+        return None
+    ENCODERS[model] = (enc, None)
+    return enc
+
+def count_tokens(text, model=EMBED_MODEL):
+    enc = encoder(model)
+    if enc is None: return len(text) // 4 + 1
+    return len(enc.encode(text, disallowed_special=()))
+
+def truncate_tokens(text, n, model=EMBED_MODEL):
+    enc = encoder(model)
+    if enc is None: return text[:n * 4]
+    toks = enc.encode(text, disallowed_special=())
+    return text if len(toks) <= n else enc.decode(toks[:n])
+
+def embed_request(inputs):
+    for attempt in range(EMBED_RETRIES + 1):
+        try:
+            with timed("embed_request"):
+                res = openai.embeddings.create(input=inputs, model=EMBED_MODEL)
+            break
+        except EMBED_RETRY_ERRORS:
+            METRICS.inc("embed_retries")
+            if attempt == EMBED_RETRIES: raise
+            time.sleep(min(30, 0.5 * 2 ** attempt) * (1 + random.random()))
+    if res.usage:
+        METRICS.inc("embed_tokens", res.usage.total_tokens)
+        METRICS.inc("embed_cost_usd", res.usage.total_tokens / 1000 * EMBED_COST_PER_KTOKENS)
+    data = sorted(res.data, key=lambda d: d.index)
+    return np.array([d.embedding for d in data], dtype="float32")
+
 def embed(text):
     if len(text) > MAX_CHARS_PER_CHUNK:
         return None
-    res = openai.embeddings.create(input=text, model=EMBED_MODEL)
-    return np.array(res.data[0].embedding, dtype="float32")
+    return embed_request(text)[0]
+
+def pack_batches(items):
+    batch, batch_tokens = [], 0
+    for i, ntok in items:
+        if batch and (len(batch) == EMBED_BATCH_INPUTS or batch_tokens + ntok > EMBED_BATCH_TOKENS):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += ntok
+    if batch: yield batch
+
+def embed_many(items, on_batch=None):
+    """Embed (text, n_tokens) pairs in token-bounded batches, EMBED_WORKERS requests at a time.
+
+    `items` may be a lazy iterable: batches are sent as soon as they fill, with at most
+    2 * EMBED_WORKERS in flight, so upstream extraction overlaps with embedding.
+    `on_batch(n_texts, n_tokens)` is called as each batch lands. Returns (texts, tokens,
+    embs) with one float32 row per text, in input order.
+    """
+    texts, tokens, results, futures = [], [], [], {}
+
+    def numbered():
+        for t, n in items:
+            texts.append(t)
+            tokens.append(n)
+            yield len(texts) - 1, n
+
+    def collect(done):
+        for fut in done:
+            b = futures.pop(fut)
+            results.append((b, fut.result()))
+            if on_batch: on_batch(len(b), sum(tokens[i] for i in b))
+
+    try:
+        for b in pack_batches(numbered()):
+            if len(futures) >= 2 * EMBED_WORKERS: collect(wait(futures, return_when=FIRST_COMPLETED).done)
+            futures[EMBED_POOL.submit(embed_request, [texts[i] for i in b])] = b
+        while futures: collect(wait(futures, return_when=FIRST_COMPLETED).done)
+    finally:
+        for fut in futures: fut.cancel()
+    if not results: return texts, tokens, np.empty((0, 0), dtype="float32")
+    out = np.empty((len(texts), results[0][1].shape[1]), dtype="float32")
+    for b, vecs in results: out[b] = vecs
+    return texts, tokens, out
+
+def top_k_desc(sims, k):
+    k = min(k, len(sims))
+    if k <= 0: return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(sims, len(sims) - k)[-k:]
+    return idx[np.argsort(sims[idx])[::-1]]
+
+class FlatSearch:
+    """Exact search: every live row is a candidate."""
+    def sync(self, embs, start): return False
+    def remove(self, keep): pass
+    def candidates(self, q): return None
+
+class IVFSearch:
+    """Inverted-file search: k-means cells over the rows, probe the closest `nprobe` cells.
+
+    Below `min_rows` it behaves like FlatSearch. It retrains whenever the corpus has doubled
+    since the last fit; rows added in between are assigned to their nearest existing cell.
+    Training runs in `train` on a snapshot without the index lock; `install` swaps the
+    result in under it.
+    """
+    def __init__(self, min_rows=IVF_MIN_ROWS, nprobe=IVF_NPROBE, iters=10):
+        self.min_rows, self.nprobe, self.iters = min_rows, nprobe, iters
+        self.centroids = None
+        self.assign    = np.empty(0, dtype=np.int32)
+        self.trained_n = 0
+        self.training  = False
+
+    def train(self, embs):
+        """k-means over `embs`; returns (centroids, assignments). Needs no lock."""
+        n     = len(embs)
+        nlist = max(1, int(np.sqrt(n)))
+        rng   = np.random.default_rng(0)
+        sample = embs[np.sort(rng.choice(n, min(n, nlist * 64), replace=False))]
+        cents  = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(self.iters):
+            labels = (sample @ cents.T).argmax(1)
+            sums   = np.zeros_like(cents)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=nlist)
+            filled = counts > 0
+            cents[filled] = sums[filled] / counts[filled, None]
+            cents /= np.linalg.norm(cents, axis=1, keepdims=True) + 1e-12
+        return cents, self.nearest(embs, cents)
+
+    def install(self, fitted, embs, trained_n):
+        """Adopt a finished fit of the first `trained_n` rows of `embs`; the caller holds the lock."""
+        self.training = False
+        if fitted is None or len(embs) < self.min_rows: return
+        self.centroids = fitted[0]
+        self.assign    = np.concatenate([fitted[1], self.nearest(embs[trained_n:], fitted[0])])
+        self.trained_n = trained_n
+
+    def nearest(self, embs, cents=None, block=4096):
+        cents = self.centroids if cents is None else cents
+        out = np.empty(len(embs), dtype=np.int32)
+        for i in range(0, len(embs), block):
+            out[i:i+block] = (embs[i:i+block] @ cents.T).argmax(1)
+        return out
+
+    def sync(self, embs, start):
+        """Account for rows appended at `start`; returns True when a retrain should start."""
+        if len(embs) < self.min_rows:
+            self.centroids, self.trained_n = None, 0
+            return False
+        if self.centroids is not None:
+            self.assign = np.concatenate([self.assign[:start], self.nearest(embs[start:])])
+        if self.training or (self.centroids is not None and len(embs) < 2 * self.trained_n): return False
+        self.training = True
+        return True
+
+    def remove(self, keep):
+        if self.centroids is not None: self.assign = self.assign[keep]
+
+    def candidates(self, q):
+        if self.centroids is None: return None
+        probe = top_k_desc(self.centroids @ q, self.nprobe)
+        return np.flatnonzero(np.isin(self.assign, probe))
+
+SEARCH_BACKENDS = {"flat": FlatSearch, "ivf": IVFSearch}
+
+class VectorIndex:
+    """Process-wide embedding matrix kept in step with the chunks table.
+
+    Rows live in one contiguous float32 buffer that grows geometrically; `ids`, `file_ids`
+    and `texts` are parallel to it. Removal builds new arrays instead of compacting in place,
+    so a search can work on a snapshot taken under the lock without holding it. Adding a
+    chunk id that is already present is a no-op, so a resync can overlap local writes.
+    `synced` is the FILES.version the rows were last reconciled with the table at.
+    """
+    def __init__(self, backend=None):
+        self.lock     = threading.Lock()
+        self.backend  = backend or FlatSearch()
+        self.embs     = None
+        self.n        = 0
+        self.ids, self.file_ids, self.texts = [], [], []
+        self.id_set   = set()
+        self.synced   = None
+        self.generation = 0
+
+    def __len__(self): return self.n
+
+    def add(self, ids, file_ids, texts, embs):
+        if not len(ids): return
+        embs = np.asarray(embs, dtype=np.float32).reshape(len(ids), -1)
+        with self.lock:
+            fresh = [i for i, x in enumerate(ids) if x not in self.id_set]
+            if not fresh: return
+            if len(fresh) < len(ids):
+                ids, file_ids, texts = [[col[i] for i in fresh] for col in (ids, file_ids, texts)]
+                embs = embs[fresh]
+            need = self.n + len(embs)
+            if self.embs is None:
+                self.embs = np.ascontiguousarray(embs)
+            else:
+                if need > len(self.embs):
+                    grown = np.empty((max(need, 2 * len(self.embs), 1024), embs.shape[1]), dtype=np.float32)
+                    grown[:self.n] = self.embs[:self.n]
+                    self.embs = grown
+                self.embs[self.n:need] = embs
+            start, self.n = self.n, need
+            self.ids      += list(ids)
+            self.id_set.update(ids)
+            self.file_ids += list(file_ids)
+            self.texts    += list(texts)
+            if not self.backend.sync(self.embs[:self.n], start): return
+            snapshot, generation = self.embs[:self.n], self.generation
+        threading.Thread(target=self.retrain, args=(snapshot, generation), daemon=True).start()
+
+    def retrain(self, snapshot, generation):
+        """Fit the search backend on `snapshot` without the lock, then swap it in.
+
+        Rows never change in place, so the snapshot stays valid while others are appended;
+        if rows were removed meanwhile the fit is redone on the current rows.
+        """
+        while True:
+            fitted = None
+            try:
+                fitted = self.backend.train(snapshot)
+            except Exception as e:
+                print("Vector index training failed:", e)
+            with self.lock:
+                if fitted is not None and self.generation != generation and self.n >= self.backend.min_rows:
+                    snapshot, generation = self.embs[:self.n], self.generation
+                    continue
+                self.backend.install(fitted if self.generation == generation else None,
+                                     self.embs[:self.n], len(snapshot))
+                return
+
+    def remove(self, file_id):
+        with self.lock:
+            return self.keep(np.fromiter((f != file_id for f in self.file_ids), dtype=bool, count=self.n))
+
+    def remove_ids(self, ids):
+        if not ids: return 0
+        with self.lock:
+            return self.keep(np.fromiter((x not in ids for x in self.ids), dtype=bool, count=self.n))
+
+    def keep(self, keep):
+        """Drop the rows where `keep` is False; the caller holds the lock."""
+        if keep.all(): return 0
+        live = self.embs[:self.n][keep]
+        removed, self.n = self.n - len(live), len(live)
+        self.generation += 1
+        self.embs     = live
+        self.ids      = [x for x, k in zip(self.ids, keep) if k]
+        self.id_set   = set(self.ids)
+        self.file_ids = [x for x, k in zip(self.file_ids, keep) if k]
+        self.texts    = [x for x, k in zip(self.texts, keep) if k]
+        self.backend.remove(keep)
+        return removed
+
+    def stored_ids(self):
+        with self.lock: return set(self.id_set)
+
+    def search(self, q_emb, top_k=5):
+        if q_emb is None: return []
+        q = np.asarray(q_emb, dtype=np.float32).ravel()
+        with self.lock:
+            if not self.n: return []
+            embs, texts = self.embs[:self.n], self.texts
+            cand = self.backend.candidates(q)
+        if cand is not None: embs = embs[cand]
+        sims = embs @ q
+        idxs = top_k_desc(sims, top_k)
+        pos  = idxs if cand is None else cand[idxs]
+        return [(texts[p], float(sims[i])) for p, i in zip(pos, idxs)]
+
+VECTORS = VectorIndex(SEARCH_BACKENDS[VECTOR_BACKEND]())
+
+STORED_ROWS = "FROM chunks WHERE emb IS NOT NULL AND emb_dtype IS NOT NULL"
+
+def decode_embs(blobs, dtypes, scales):
+    """Decode a block of stored embeddings into float32 rows with one frombuffer per dtype."""
+    groups = {}
+    for i, dtype in enumerate(dtypes): groups.setdefault(dtype, []).append(i)
+    out = None
+    for dtype, rows in groups.items():
+        vecs = np.frombuffer(b"".join(blobs[i] for i in rows), dtype=dtype).reshape(len(rows), -1)
+        if out is None: out = np.empty((len(blobs), vecs.shape[1]), dtype=np.float32)
+        if len(rows) == len(blobs): out[:] = vecs
+        else: out[rows] = vecs
+    if any(s is not None for s in scales):
+        out *= np.array([s or 1.0 for s in scales], dtype=np.float32)[:, None]
+    return out
+
+def load_embeddings(ids=None, batch=4096):
+    """Read stored embeddings block by block into one preallocated float32 matrix.
+
+    Loads every row, or only the chunk `ids` given. Returns (ids, file_ids, texts, embs).
+    A full load is bounded by the largest id seen alongside the count, so rows another
+    worker commits mid-scan cannot overflow the buffer; the next sync_vectors picks them up.
+    """
+    with ENG.connect() as conn:
+        if ids is None:
+            n, max_id = conn.execute(text(f"SELECT COUNT(*), MAX(id) {STORED_ROWS}")).one()
+            parts = conn.execution_options(stream_results=True).execute(text(
+                f"SELECT id, file_id, text, emb, emb_dtype, emb_scale {STORED_ROWS} AND id <= :max_id ORDER BY id"),
+                {"max_id": max_id}).partitions(batch)
+        else:
+            wanted = sorted(ids)
+            n      = len(wanted)
+            stmt = text(f"SELECT id, file_id, text, emb, emb_dtype, emb_scale {STORED_ROWS} AND id IN :ids ORDER BY id"
+                        ).bindparams(bindparam("ids", expanding=True))
+            parts = (conn.execute(stmt, {"ids": wanted[i:i+500]}).all() for i in range(0, n, 500))
+        ids, file_ids, texts, embs = [], [], [], None
+        if not n: return ids, file_ids, texts, embs
+        for part in parts:
+            if not part: continue
+            cids, fids, txts, blobs, dtypes, scales = zip(*part)
+            block = decode_embs(blobs, dtypes, scales)
+            if embs is None: embs = np.empty((n, block.shape[1]), dtype=np.float32)
+            embs[len(ids):len(ids) + len(block)] = block
+            ids += cids; file_ids += fids; texts += txts
+    return ids, file_ids, texts, None if embs is None else embs[:len(ids)]
+
+def migrate_rows(dtype, legacy_only=False, batch=1000):
+    """Re-encode stored embeddings as raw `dtype` bytes; returns how many rows were rewritten.
+
+    Rows are read outside the write transactions and each update re-checks the old dtype,
+    so several workers starting at once can run it side by side.
+    """
+    where = "emb_dtype IS NULL" if legacy_only else "(emb_dtype IS NULL OR emb_dtype != :dtype)"
+    with ENG.connect() as conn:
+        rows = conn.execute(text(f"SELECT id, emb, emb_dtype, emb_scale FROM chunks WHERE emb IS NOT NULL AND {where}"),
+                            {"dtype": dtype}).all()
+    for i in range(0, len(rows), batch):
+        updates = []
+        for cid, blob, old, scale in rows[i:i+batch]:
+            vec = pickle.loads(blob) if old is None else np.frombuffer(blob, dtype=old) * (scale or 1.0)
+            new_blob, new_scale = encode_emb(vec, dtype)
+            updates.append({"id": cid, "emb": new_blob, "dtype": dtype, "scale": new_scale, "old": old})
+        with ENG.begin() as conn:
+            conn.execute(text("UPDATE chunks SET emb = :emb, emb_dtype = :dtype, emb_scale = :scale "
+                              "WHERE id = :id AND emb_dtype IS :old"), updates)
+    return len(rows)
+
+def load_vectors():
+    """Load the chunks of every published document; rows of unlisted documents are left out."""
+    live = {d["id"] for d in load_index()}
+    VECTORS.synced = FILES.version
+    ids, file_ids, texts, embs = load_embeddings()
+    keep = [i for i, f in enumerate(file_ids) if f in live]
+    if len(keep) < len(ids):
+        ids, file_ids, texts = [[col[i] for i in keep] for col in (ids, file_ids, texts)]
+        embs = embs[keep] if keep else None
+    VECTORS.add(ids, file_ids, texts, embs)
+    return len(ids)
+
+VECTORS_SYNC = threading.Lock()
+
+def sync_vectors():
+    """Reconcile VECTORS with the chunks table after the document set changed.
+
+    Other worker processes write chunks and `_index.json` too; FileCache notices their
+    index writes (as well as ours) and bumps its version. Rows are then diffed by id, so
+    only chunks added elsewhere are read and chunks deleted elsewhere are dropped. Chunks
+    of documents not yet published in the index are left out until they are.
+    """
+    live = {d["id"] for d in load_index()}
+    version = FILES.version
+    if VECTORS.synced == version: return
+    with VECTORS_SYNC:
+        if VECTORS.synced == version: return
+        have = VECTORS.stored_ids()
+        with ENG.connect() as conn:
+            stored = {cid for cid, fid in conn.execute(text(f"SELECT id, file_id {STORED_ROWS}")) if fid in live}
+        VECTORS.remove_ids(have - stored)
+        ids, file_ids, texts, embs = load_embeddings(stored - have)
+        VECTORS.add(ids, file_ids, texts, embs)
+        VECTORS.synced = version
 
 @handle_db
-def add_chunk(sess, file_id, text, embed_ok=True):
-    vec = embed(text) if embed_ok else None
-    if vec is not None:
-        sess.add(Chunk(file_id=file_id, text=text, emb=pickle.dumps(vec)))
-        sess.commit()
-        return len(text), len(vec)
-    return len(text), 0
+def add_chunks(sess, file_id, texts, embs):
+    if not texts: return []
+    rows = []
+    for t, v in zip(texts, embs):
+        blob, scale = encode_emb(v)
+        rows.append({"file_id": file_id, "text": t, "emb": blob, "emb_dtype": EMBED_STORAGE, "emb_scale": scale,
+                     "hash": chunk_hash(t)})
+    ids  = sess.scalars(insert(Chunk).returning(Chunk.id, sort_by_parameter_order=True), rows).all()
+    sess.commit()
+    return ids
 
 @handle_db
-def query_chunks(sess, q_emb, top_k=5):
-    rows = sess.query(Chunk).all()
-    if not rows: return []
-    embs = np.vstack([pickle.loads(r.emb) for r in rows])
-    sims = (embs @ q_emb).flatten()
-    idxs = sims.argsort()[-top_k:][::-1]
-    return [(rows[i].text, float(sims[i])) for i in idxs]
+def delete_chunks(sess, file_id):
+    n = sess.query(Chunk).filter(Chunk.file_id == file_id).delete()
+    sess.commit()
+    VECTORS.remove(file_id)
+    return n
 
-def extract_text(path, ext):
+def stored_embedding(conn, h):
+    row = conn.execute(text("SELECT emb, emb_dtype, emb_scale FROM chunks "
+                            "WHERE hash = :h AND emb_dtype IS NOT NULL LIMIT 1"), {"h": h}).first()
+    if row is None: return None
+    return np.frombuffer(row.emb, dtype=row.emb_dtype).astype("float32") * (row.emb_scale or 1.0)
+
+def query_chunks(q_emb, top_k=5):
+    sync_vectors()
+    return VECTORS.search(q_emb, top_k)
+
+class MemoryHistory:
+    """In-process conversation store: LRU over sessions, idle-TTL eviction, per-session cap."""
+    def __init__(self, max_sessions=HISTORY_MAX_SESSIONS, max_messages=MAX_HISTORY_MESSAGES,
+                 ttl=HISTORY_TTL_SECONDS):
+        self.max_sessions, self.max_messages, self.ttl = max_sessions, max_messages, ttl
+        self.lock     = threading.Lock()
+        self.sessions: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def expire(self, now):
+        while self.sessions:
+            key, (touched, _) = next(iter(self.sessions.items()))
+            if now - touched < self.ttl and len(self.sessions) <= self.max_sessions: break
+            del self.sessions[key]
+
+    def get(self, key) -> List[Dict]:
+        with self.lock:
+            self.expire(time.time())
+            entry = self.sessions.get(key)
+            return list(entry[1]) if entry else []
+
+    def append(self, key, *messages):
+        now = time.time()
+        with self.lock:
+            msgs = self.sessions.pop(key, (now, []))[1] + list(messages)
+            self.sessions[key] = (now, msgs[-self.max_messages:])
+            self.expire(now)
+
+    def clear(self, key):
+        with self.lock: self.sessions.pop(key, None)
+
+HistoryBase = declarative_base()
+
+class HistoryMessage(HistoryBase):
+    __tablename__ = "messages"
+    id      = Column(Integer, primary_key=True)
+    sid     = Column(String, index=True)
+    role    = Column(String)
+    content = Column(String)
+    ts      = Column(Float, index=True)
+
+class SQLiteHistory:
+    """Conversation store shared by every worker process through one SQLite file."""
+    def __init__(self, path=HISTORY_DB, max_messages=MAX_HISTORY_MESSAGES, ttl=HISTORY_TTL_SECONDS,
+                 sweep_every=60):
+        self.max_messages, self.ttl, self.sweep_every = max_messages, ttl, sweep_every
+        self.engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 30})
+        event.listen(self.engine, "connect", lambda conn, _: conn.execute("PRAGMA journal_mode=WAL"))
+        create_tables(HistoryBase.metadata, self.engine)
+        self.swept = 0.0
+
+    def get(self, key) -> List[Dict]:
+        cutoff = time.time() - self.ttl
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select(HistoryMessage.role, HistoryMessage.content, HistoryMessage.ts)
+                .where(HistoryMessage.sid == key)
+                .order_by(HistoryMessage.id.desc()).limit(self.max_messages)).all()
+        if not rows or rows[0].ts < cutoff: return []
+        return [{ "role": r.role, "content": r.content } for r in reversed(rows)]
+
+    def append(self, key, *messages):
+        now = time.time()
+        with self.engine.begin() as conn:
+            conn.execute(insert(HistoryMessage), [
+                {"sid": key, "role": m["role"], "content": m["content"], "ts": now} for m in messages])
+            keep = (select(HistoryMessage.id).where(HistoryMessage.sid == key)
+                    .order_by(HistoryMessage.id.desc()).limit(self.max_messages))
+            conn.execute(delete(HistoryMessage).where(HistoryMessage.sid == key, HistoryMessage.id.not_in(keep)))
+            if now - self.swept > self.sweep_every:
+                self.swept = now
+                idle = (select(HistoryMessage.sid).group_by(HistoryMessage.sid)
+                        .having(func.max(HistoryMessage.ts) < now - self.ttl))
+                conn.execute(delete(HistoryMessage).where(HistoryMessage.sid.in_(idle)))
+
+    def clear(self, key):
+        with self.engine.begin() as conn:
+            conn.execute(delete(HistoryMessage).where(HistoryMessage.sid == key))
+
+HISTORY_BACKENDS = {"memory": MemoryHistory, "sqlite": SQLiteHistory}
+HISTORY = None  # created by init_app
+
+EXTRACT_POOL = None
+
+def extract_pool():
+    global EXTRACT_POOL
+    with LOCK:
+        if EXTRACT_POOL is None and EXTRACT_WORKERS > 1:
+            EXTRACT_POOL = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, mp_context=mp.get_context("spawn"))
+    return EXTRACT_POOL
+
+def extract_pages(path, ext, on_page=None):
+    """Yield the pages of an upload. Extraction errors propagate so the ingestion job fails
+    and is discarded rather than indexing the pages read before the error."""
     try:
-        if ext == ".txt":
-            with open(path, "r", encoding="utf-8", errors="ignore") as f:
-                return f.read()
-        if ext == ".pdf":
-            txt = "\n".join(p.extract_text() or "" for p in PdfReader(path).pages[:10])
-            if not txt.strip():
-                txt = pdfminer_text(path, maxpages=10)
-            if not txt.strip():
-                with fitz.open(path) as doc:
-                    txt = "\n".join(p.get_text() for p in doc[:10])
-            return txt
-        if ext == ".docx":
-            d = docx.Document(path)
-            return "\n".join(p.text for p in d.paragraphs[:300])
-        if ext in (".xls", ".xlsx"):
-            return pd.read_excel(path).to_csv(index=False)
-    except Exception as e:
-        print("Extraction failed:", e)
-    return ""
-
-def build_chunks(file_id, text, rows_per_chunk=50):
-    lines = text.splitlines()
-    if not lines: return {"chunks": 0, "skipped": 0, "token_est": 0}
-    chunk_count, skipped, token_total = 0, 0, 0
-    for i in range(0, len(lines), rows_per_chunk):
-        chunk = "\n".join(lines[i:i+rows_per_chunk])
-        embed_ok = len(chunk) < MAX_CHARS_PER_CHUNK
-        chunk_len, emb_len = add_chunk(file_id, chunk, embed_ok=embed_ok)
-        chunk_count += 1
-        if emb_len == 0: skipped += 1
-        token_total += int(chunk_len / 4)
+        pages = extract.iter_pages(path, ext, max_pages=PDF_MAX_PAGES, max_paragraphs=DOCX_MAX_PARAGRAPHS,
+                                   pool=extract_pool() if ext == ".pdf" else None,
+                                   workers=EXTRACT_WORKERS, inflight=2 * EXTRACT_WORKERS)
+        spent, start = 0.0, time.perf_counter()
+        for page in pages:
+            spent += time.perf_counter() - start
+            METRICS.inc("extract_pages")
+            yield page
+            if on_page: on_page()
+            start = time.perf_counter()
+        METRICS.observe("extract_text", spent)
+    except BrokenExecutor as e:
+        global EXTRACT_POOL
+        print("Extraction pool failed, restarting it:", e)
+        with LOCK:
+            if EXTRACT_POOL is not None: EXTRACT_POOL.shutdown(wait=False, cancel_futures=True)
+            EXTRACT_POOL = None
+        raise
+
+def extract_text(path, ext):
+    return "\n".join(extract_pages(path, ext))
+
+def iter_chunks(pages, rows_per_chunk=50):
+    lines = []
+    for page in pages:
+        lines.extend(page.splitlines())
+        while len(lines) >= rows_per_chunk:
+            yield "\n".join(lines[:rows_per_chunk])
+            del lines[:rows_per_chunk]
+    if lines: yield "\n".join(lines)
+
+def build_chunks(file_id, pages, rows_per_chunk=50, job=None):
+    """Chunk, embed and store `pages`; returns (stats, (ids, texts, embs)).
+
+    The rows are written to the chunks table only: the caller adds them to VECTORS once
+    the document is published, so chat never retrieves a half-indexed upload.
+    """
+    if isinstance(pages, str): pages = [pages]
+    counts = {"chunks": 0, "skipped": 0, "reused": 0}
+    reused_texts, reused_embs = [], []
+
+    def embeddable(conn):
+        for chunk in iter_chunks(pages, rows_per_chunk):
+            counts["chunks"] += 1
+            n = count_tokens(chunk)
+            if n >= MAX_TOKENS_PER_CHUNK or (encoder() is None and len(chunk) > MAX_CHARS_PER_CHUNK):
+                counts["skipped"] += 1
+                continue
+            vec = stored_embedding(conn, chunk_hash(chunk))
+            if vec is not None:
+                counts["reused"] += 1
+                reused_texts.append(chunk)
+                reused_embs.append(vec)
+                continue
+            if job: job.set(chunks=counts["chunks"] - counts["skipped"] - counts["reused"])
+            yield chunk, n
+
+    with timed("build_chunks"), ENG.connect() as conn:
+        texts, tokens, embs = embed_many(embeddable(conn), on_batch=job.embedded if job else None)
+    if reused_texts:
+        texts = texts + reused_texts
+        embs  = np.vstack(([embs] if len(embs) else []) + reused_embs)
+    if job: job.check()
+    with timed("add_chunks"):
+        ids = add_chunks(file_id, texts, embs)
+    for k, v in counts.items(): METRICS.inc(f"ingest_{k}", v)
+    token_total = sum(tokens)
     return {
-        "chunks": chunk_count,
-        "skipped": skipped,
+        **counts,
         "token_est": token_total,
         "cost_est": round(token_total / 1000 * EMBED_COST_PER_KTOKENS, 6)
-    }
+    }, (ids, texts, embs)
 
-def load_index():
-    if not os.path.exists(INDEX_FILE): return []
-    with open(INDEX_FILE, "r", encoding="utf-8") as f:
+def file_stamp(paths):
+    stamp = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            stamp.append((p, st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamp.append((p, None, None))
+    return tuple(stamp)
+
+class FileCache:
+    """Values derived from files on disk, rebuilt only when one of those files changes.
+
+    Files are stat'ed at most once every `interval` seconds, so the per-request path
+    normally does no disk I/O; writers call `invalidate` to publish their own changes at
+    once. `version` increments on every invalidation.
+    """
+    def __init__(self, interval=CACHE_STAT_SECONDS):
+        self.interval = interval
+        self.lock     = threading.Lock()
+        self.entries  = {}
+        self.version  = 0
+
+    def get(self, key, paths, build):
+        now   = time.monotonic()
+        entry = self.entries.get(key)
+        if entry and now - entry[2] < self.interval: return entry[1]
+        stamp = file_stamp(paths())
+        value = entry[1] if entry and entry[0] == stamp else build()
+        with self.lock:
+            if entry and entry[0] != stamp: self.version += 1
+            self.entries[key] = (stamp, value, now)
+        return value
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.version += 1
+
+FILES = FileCache()
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock    = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize: self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock: self.entries.clear()
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+class AnswerCache(LRUCache):
+    """Semantic answer cache: a stored answer is reused when a new query embedding is within
+    `threshold` cosine similarity of the stored one in the same scope (persona, model).
+
+    Entries expire after `ttl` seconds and are dropped wholesale whenever the FileCache
+    version moves, i.e. when documents or personas change.
+    """
+    def __init__(self, maxsize=ANSWER_CACHE_SIZE, threshold=ANSWER_CACHE_THRESHOLD,
+                 ttl=ANSWER_CACHE_TTL, enabled=ANSWER_CACHE_ENABLED):
+        super().__init__(maxsize)
+        self.threshold, self.ttl, self.enabled = threshold, ttl, enabled
+        self.version  = None
+        self.matrices = {}
+
+    def sync(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.matrices.clear()
+            self.version = version
+
+    def matrix(self, scope):
+        if scope not in self.matrices:
+            keys = [k for k in self.entries if k[0] == scope]
+            embs = np.vstack([self.entries[k][0] for k in keys]) if keys else None
+            self.matrices[scope] = (keys, embs)
+        return self.matrices[scope]
+
+    def lookup(self, scope, q_emb, version):
+        if q_emb is None: return None
+        with self.lock:
+            self.sync(version)
+            keys, embs = self.matrix(scope)
+            if keys:
+                sims = embs @ q_emb
+                i    = int(sims.argmax())
+                if sims[i] >= self.threshold:
+                    _, answer, stored = self.entries[keys[i]]
+                    if time.time() - stored < self.ttl:
+                        self.entries.move_to_end(keys[i])
+                        self.hits += 1
+                        return answer
+                    del self.entries[keys[i]]
+                    self.matrices.pop(scope, None)
+            self.misses += 1
+        return None
+
+    def store(self, scope, query, q_emb, answer, version):
+        if q_emb is None: return
+        with self.lock:
+            if version != self.version: return
+            self.entries[(scope, query)] = (q_emb, answer, time.time())
+            self.entries.move_to_end((scope, query))
+            self.matrices.pop(scope, None)
+            while len(self.entries) > self.maxsize:
+                (old_scope, _), _ = self.entries.popitem(last=False)
+                self.matrices.pop(old_scope, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.matrices.clear()
+
+    def stats(self):
+        return {**super().stats(), "enabled": self.enabled, "threshold": self.threshold}
+
+QUERY_CACHE  = LRUCache(QUERY_CACHE_SIZE)
+ANSWER_CACHE = AnswerCache()
+FAQ_EXCERPTS = LRUCache(64)
+
+def normalize_query(text):
+    return " ".join(text.lower().split())
+
+def embed_query(text):
+    key = normalize_query(text)
+    vec = QUERY_CACHE.get(key)
+    if vec is None:
+        vec = embed(text)
+        if vec is not None: QUERY_CACHE.put(key, vec)
+    return vec
+
+def read_json(path, default):
+    if not os.path.exists(path): return default
+    with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
+def load_index():
+    return list(FILES.get("index", lambda: [INDEX_FILE], lambda: read_json(INDEX_FILE, [])))
+
 def save_index(idx):
     with LOCK:
         with open(INDEX_FILE, "w", encoding="utf-8") as f:
             json.dump(idx, f, indent=2)
+        FILES.invalidate()
 
-def add_doc(file_storage, rows_per_chunk=50):
-    idx  = load_index()
+def stage_doc(file_storage):
     orig = secure_filename(file_storage.filename)
     ext  = os.path.splitext(orig)[1].lower()
     uid  = str(uuid.uuid4())
     bin_path = os.path.join(UPLOAD_DIR, f"{uid}{ext}")
     file_storage.save(bin_path)
-
-    text = extract_text(bin_path, ext)
-    txt_path = bin_path if ext == ".txt" else os.path.join(UPLOAD_DIR, f"{uid}.txt")
-    if ext != ".txt":
-        with open(txt_path, "w", encoding="utf-8") as f:
-            f.write(text)
-
-    meta = {
+    return {
         "id": uid, "name": orig,
         "file": os.path.basename(bin_path),
-        "text_file": os.path.basename(txt_path),
+        "text_file": os.path.basename(bin_path) if ext == ".txt" else f"{uid}.txt",
         "size": os.path.getsize(bin_path),
+        "sha256": file_sha256(bin_path),
         "uploaded": datetime.utcnow().isoformat() + "Z"
     }
 
-    stats = build_chunks(uid, text, rows_per_chunk)
-    meta.update(stats)
+def ingest_doc(meta, rows_per_chunk=50, job=None, replace=False):
+    with timed("ingest_doc"):
+        return index_doc(meta, rows_per_chunk, job, replace)
+
+def indexed_copy(idx, meta):
+    return next((d for d in idx if d.get("sha256") == meta["sha256"]), None)
+
+def keep_duplicate(meta, dup, job=None):
+    """Drop a staged upload whose bytes are already indexed as `dup`; its job now reports `dup`."""
+    discard_doc(meta)
+    if job: job.set(meta=dup, duplicate_of=dup["name"])
+    return dup
 
-    idx.append(meta)
-    save_index(idx)
+def index_doc(meta, rows_per_chunk=50, job=None, replace=False):
+    """Extract, chunk and embed a staged upload, then publish it in the index.
+
+    A byte-identical upload resolves to the document already indexed; the check is
+    repeated under LOCK before publishing, so concurrent identical uploads index once.
+    With `replace`, earlier documents of the same name are removed once this one is in.
+    """
+    dup = indexed_copy(load_index(), meta)
+    if dup: return keep_duplicate(meta, dup, job)
+
+    bin_path = os.path.join(UPLOAD_DIR, meta["file"])
+    txt_path = os.path.join(UPLOAD_DIR, meta["text_file"])
+    pages = extract_pages(bin_path, os.path.splitext(bin_path)[1], on_page=job.page if job else None)
+    if txt_path == bin_path:
+        stats, rows = build_chunks(meta["id"], pages, rows_per_chunk, job)
+    else:
+        with open(txt_path, "w", encoding="utf-8") as f:
+            def tee():
+                for i, page in enumerate(pages):
+                    f.write(f"\n{page}" if i else page)
+                    yield page
+            stats, rows = build_chunks(meta["id"], tee(), rows_per_chunk, job)
+
+    meta.update(stats)
+    with LOCK:
+        idx = load_index()
+        dup = indexed_copy(idx, meta)
+        if dup: return keep_duplicate(meta, dup, job)
+        old = [d for d in idx if replace and d["name"] == meta["name"]]
+        for d in old: discard_doc(d)
+        save_index([d for d in idx if d not in old] + [meta])
+        ids, texts, embs = rows
+        VECTORS.add(ids, [meta["id"]] * len(ids), texts, embs)
     return meta
 
-def delete_doc(doc_id):
-    idx = load_index()
-    doc = next((d for d in idx if d["id"] == doc_id), None)
-    if not doc: return False
-    for f in {doc["file"], doc.get("text_file", doc["file"])}:
+def discard_doc(meta):
+    for f in {meta["file"], meta.get("text_file", meta["file"])}:
         try: os.remove(os.path.join(UPLOAD_DIR, f))
         except: pass
-    save_index([d for d in idx if d["id"] != doc_id])
+    delete_chunks(meta["id"])
+
+def add_doc(file_storage, rows_per_chunk=50, replace=False):
+    return ingest_doc(stage_doc(file_storage), rows_per_chunk, replace=replace)
+
+def delete_doc(doc_id):
+    with LOCK:
+        idx = load_index()
+        doc = next((d for d in idx if d["id"] == doc_id), None)
+        if not doc: return False
+        discard_doc(doc)
+        save_index([d for d in idx if d["id"] != doc_id])
     return True
 
-def load_personas():
+class IngestCancelled(Exception):
+    pass
+
+class IngestJob:
+    """Progress and cancellation state for one uploaded file being indexed in the background."""
+    def __init__(self, meta, rows_per_chunk=50, replace=False):
+        self.id, self.meta, self.rows_per_chunk = str(uuid.uuid4()), meta, rows_per_chunk
+        self.name, self.replace = meta["name"], replace
+        self.duplicate_of = None
+        self.status  = "queued"
+        self.error   = None
+        self.pages   = self.chunks = self.chunks_embedded = self.tokens = 0
+        self.created = time.time()
+        self.finished  = None
+        self.future    = None
+        self.cancelled = threading.Event()
+        self.lock      = threading.Lock()
+
+    def set(self, **kw):
+        with self.lock:
+            for k, v in kw.items(): setattr(self, k, v)
+
+    def check(self):
+        if self.cancelled.is_set(): raise IngestCancelled()
+
+    def page(self):
+        self.check()
+        with self.lock: self.pages += 1
+
+    def embedded(self, n_chunks, n_tokens):
+        with self.lock:
+            self.chunks_embedded += n_chunks
+            self.tokens += n_tokens
+        self.check()
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "id": self.id, "name": self.name, "doc_id": self.meta["id"],
+                "duplicate_of": self.duplicate_of, "status": self.status, "error": self.error,
+                "pages": self.pages, "chunks": self.chunks,
+                "chunks_embedded": self.chunks_embedded, "tokens": self.tokens,
+                "cost": round(self.tokens / 1000 * EMBED_COST_PER_KTOKENS, 6),
+            }
+
+INGEST_POOL = None  # created by init_app
+# Jobs live in the process that accepted the upload. With several workers, status polls
+# must reach that same worker (sticky sessions); elsewhere /admin/jobs/<id> returns 404,
+# though the finished document still shows up in /admin/faqs for every worker.
+JOBS: Dict[str, IngestJob] = {}
+
+def run_job(job):
+    job.set(status="running")
+    try:
+        ingest_doc(job.meta, job.rows_per_chunk, job, job.replace)
+        job.set(status="done")
+    except IngestCancelled:
+        discard_doc(job.meta)
+        job.set(status="cancelled")
+    except Exception as e:
+        print("Ingestion failed:", e)
+        discard_doc(job.meta)
+        job.set(status="failed", error=str(e))
+    finally:
+        job.set(finished=time.time())
+
+def submit_job(meta, rows_per_chunk=50, replace=False):
+    job = IngestJob(meta, rows_per_chunk, replace)
+    with LOCK:
+        cutoff = time.time() - JOB_TTL_SECONDS
+        for k in [k for k, j in JOBS.items() if j.finished and j.finished < cutoff]:
+            del JOBS[k]
+        JOBS[job.id] = job
+    job.future = INGEST_POOL.submit(run_job, job)
+    return job
+
+def cancel_job(job):
+    job.cancelled.set()
+    if job.future and job.future.cancel():
+        discard_doc(job.meta)
+        job.set(status="cancelled", finished=time.time())
+
+def read_personas():
     if not os.path.exists(PERSONA_FILE):
         with open(PERSONA_FILE, "w", encoding="utf-8") as f:
             json.dump({"Default": "You are a helpful business assistant."}, f)
-    with open(PERSONA_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return read_json(PERSONA_FILE, {})
+
+def load_personas():
+    return dict(FILES.get("personas", lambda: [PERSONA_FILE], read_personas))
 
 def save_personas(data):
     with LOCK:
         with open(PERSONA_FILE, "w", encoding="utf-8") as f:
             json.dump(data, f, indent=2)
+        FILES.invalidate()
 
-def combined_faq(limit=20000):
-    txt = ""
+def faq_paths():
+    return [INDEX_FILE] + [os.path.join(UPLOAD_DIR, d.get("text_file", d["file"])) for d in load_index()]
+
+def build_faq(limit):
+    parts, size = [], 0
     for doc in load_index():
         path = os.path.join(UPLOAD_DIR, doc.get("text_file", doc["file"]))
         try:
             with open(path, "r", encoding="utf-8", errors="ignore") as f:
-                content = f.read()
+                content = f.read(limit)
         except: content = ""
-        txt += f"\n--- {doc['name']} ---\n{content}"
-        if len(txt) > limit: break
-    return txt[:limit]
+        parts.append(f"\n--- {doc['name']} ---\n{content}")
+        size += len(parts[-1])
+        if size > limit: break
+    return "".join(parts)[:limit]
+
+def combined_faq(limit=20000):
+    return FILES.get(f"faq:{limit}", faq_paths, lambda: build_faq(limit))
+
+def faq_excerpt(faq, room, model):
+    """The first `room` tokens of `faq` and their count, cached until the documents change."""
+    key = (FILES.version, model, room, len(faq))
+    hit = FAQ_EXCERPTS.get(key)
+    if hit is None:
+        excerpt = truncate_tokens(faq, room, model)
+        hit = (excerpt, count_tokens(excerpt, model))
+        FAQ_EXCERPTS.put(key, hit)
+    return hit
+
+def build_prompt(persona, chunks, history, model, budget=PROMPT_TOKEN_BUDGET, faq=""):
+    """Assemble chat messages within `budget` input tokens for `model`.
+
+    Fills in priority order: persona, retrieved chunks (deduplicated), the newest turns,
+    a clipped digest of older turns, then up to PROMPT_FAQ_TOKENS of `faq`. The latest
+    turn is always kept. Returns (messages, tokens_used), the count summed from the parts.
+    """
+    def cost(s): return count_tokens(s, model) + 4
+    head = f"{persona}\n\nUse the following reference when helpful:\n"
+    used = cost(head) + 3
+
+    refs, seen = [], set()
+    for chunk, _ in chunks:
+        norm = " ".join(chunk.split())
+        if norm in seen: continue
+        seen.add(norm)
+        n = cost(f"---\n{chunk}")
+        if used + n > budget: continue
+        refs.append(chunk)
+        used += n
+
+    turns = []
+    for msg in reversed(history):
+        n = cost(msg["content"])
+        if turns and used + n > budget: break
+        turns.append(msg)
+        used += n
+    turns.reverse()
+
+    digest = []
+    for msg in history[:len(history) - len(turns)][::-1]:
+        line = f"{msg['role']}: {truncate_tokens(' '.join(msg['content'].split()), SUMMARY_TURN_TOKENS, model)}"
+        n = cost(line)
+        if used + n > budget: break
+        digest.append(line)
+        used += n
+    digest.reverse()
+
+    faq_room = min(PROMPT_FAQ_TOKENS, budget - used - 8)
+    faq, n = faq_excerpt(faq, faq_room, model) if faq and faq_room > 0 else ("", 0)
+    used += n
+
+    reference = "\n".join(f"---\n{t}" for t in refs)
+    sys_prompt = f"{head}```\n{reference}\n{faq}\n```"
+    if digest:
+        sys_prompt += "\n\nEarlier in this conversation:\n" + "\n".join(digest)
+    messages = [{ "role": "system", "content": sys_prompt }, *turns]
+    return messages, used
 
 def sid(): return session.setdefault("sid", str(uuid.uuid4()))
 def is_admin(): return session.get("is_admin", False)
 
-PERSONAS = load_personas()
-CONV_HISTORY: Dict[str, List[Dict]] = {}
+def init_app():
+    """All per-process startup work: data directory, schema, storage migration, thread
+    pools, the history store and the vector index. Importing the module does none of it."""
+    global EMBED_POOL, INGEST_POOL, HISTORY
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    create_tables(Base.metadata, ENG)
+    ensure_columns()
+    if migrate_rows(EMBED_STORAGE, legacy_only=True): print(f"Migrated pickled embeddings to {EMBED_STORAGE}")
+    EMBED_POOL  = ThreadPoolExecutor(max_workers=EMBED_WORKERS, thread_name_prefix="embed")
+    INGEST_POOL = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+    HISTORY     = HISTORY_BACKENDS[HISTORY_BACKEND]()
+    load_vectors()
+
+# Spawned extraction workers re-import this file as __mp_main__ when it is run as a script;
+# they only need extract.py, so they skip startup.
+if __name__ != "__mp_main__":
+    init_app()
 
 @app.route("/")
 def index():
@@ -214,31 +1249,49 @@ def admin_login():
 def personas():
     if not is_admin(): return "forbidden", 403
     if request.method == "GET":
-        return jsonify(PERSONAS)
+        return jsonify(load_personas())
     data = request.get_json(force=True)
     name, txt = data.get("name", "").strip(), data.get("instructions", "").strip()
     if not name or not txt: return "bad request", 400
-    PERSONAS[name] = txt
-    save_personas(PERSONAS)
+    with LOCK:
+        data = load_personas()
+        data[name] = txt
+        save_personas(data)
     return "", 204
 
 @app.route("/admin/personas/<name>", methods=["DELETE"])
 def delete_persona(name):
     if not is_admin(): return "forbidden", 403
     if name == "Default": return "can't delete default", 400
-    PERSONAS.pop(name, None)
-    save_personas(PERSONAS)
+    with LOCK:
+        data = load_personas()
+        data.pop(name, None)
+        save_personas(data)
     return "", 204
 
 @app.route("/admin/upload", methods=["POST"])
 def admin_upload():
     if not is_admin(): return "forbidden", 403
     chunk_size = int(request.headers.get("X-Chunk-Size", "50"))
-    stats = []
-    for f in request.files.getlist("files"):
-        result = add_doc(f, rows_per_chunk=chunk_size)
-        stats.append(result)
-    return jsonify(stats)
+    replace    = request.headers.get("X-Replace-Existing") == "1"
+    jobs = [submit_job(stage_doc(f), rows_per_chunk=chunk_size, replace=replace) for f in request.files.getlist("files")]
+    return jsonify([j.to_dict() for j in jobs]), 202
+
+@app.route("/admin/jobs", methods=["GET"])
+def list_jobs():
+    if not is_admin(): return "forbidden", 403
+    with LOCK: jobs = sorted(JOBS.values(), key=lambda j: j.created)
+    return jsonify([j.to_dict() for j in jobs])
+
+@app.route("/admin/jobs/<job_id>", methods=["GET", "DELETE"])
+def job_status(job_id):
+    if not is_admin(): return "forbidden", 403
+    job = JOBS.get(job_id)
+    if not job: return "not found", 404
+    if request.method == "DELETE":
+        cancel_job(job)
+        return "", 204
+    return jsonify(job.to_dict())
 
 @app.route("/admin/faqs", methods=["GET"])
 def list_docs():
@@ -250,10 +1303,20 @@ def remove_doc(doc_id):
     if not is_admin(): return "forbidden", 403
     return ("", 204) if delete_doc(doc_id) else ("not found", 404)
 
+@app.route("/admin/cache", methods=["GET", "DELETE"])
+def cache_stats():
+    if not is_admin(): return "forbidden", 403
+    if request.method == "DELETE":
+        QUERY_CACHE.clear()
+        ANSWER_CACHE.clear()
+        FAQ_EXCERPTS.clear()
+        return "", 204
+    return jsonify(query_embeddings=QUERY_CACHE.stats(), answers=ANSWER_CACHE.stats())
+
 @app.route("/admin/clear", methods=["POST"])
 def clear_chat():
     if not is_admin(): return "forbidden", 403
-    CONV_HISTORY.pop(sid(), None)
+    HISTORY.clear(sid())
     return "", 204
 
 @app.route("/chat", methods=["POST"])
@@ -267,33 +1330,137 @@ def chat():
     if not message: return jsonify(error="empty"), 400
     if not openai.api_key: return jsonify(error="Missing OPENAI_API_KEY"), 500
 
-    persona = PERSONAS.get(persona_key, PERSONAS["Default"])
-    history = CONV_HISTORY.setdefault(sid(), [])
-    history.append({ "role": "user", "content": message })
-    history = history[-20:]
-
-    q_emb      = embed(message)
-    top_chunks = query_chunks(q_emb, top_k=5)
-    chunk_txt  = "\n".join(f"---\n{t}" for t, _ in top_chunks)
-
-    sys_prompt = (
-        f"{persona}\n\nUse the following reference when helpful:\n"
-        f"```\n{chunk_txt}\n{combined_faq()}\n```"
-    )
-
-    resp = openai.chat.completions.create(
-        model=model,
-        messages=[{ "role": "system", "content": sys_prompt }, *history],
-        temperature=temp,
-    )
+    personas = load_personas()
+    persona  = personas.get(persona_key, personas["Default"])
+    key     = sid()
+    user_msg = { "role": "user", "content": message }
+    history  = (HISTORY.get(key) + [user_msg])[-MAX_HISTORY_MESSAGES:]
+
+    with timed("embed"):
+        q_emb = embed_query(message)
+    scope   = (persona_key, model)
+    version = FILES.version
+    cacheable = ANSWER_CACHE.enabled and len(history) == 1
+
+    def finish(answer):
+        with timed("history"):
+            HISTORY.append(key, user_msg, { "role": "assistant", "content": answer })
+            if cacheable: ANSWER_CACHE.store(scope, normalize_query(message), q_emb, answer, version)
+
+    with timed("answer_cache"):
+        cached = ANSWER_CACHE.lookup(scope, q_emb, version) if cacheable else None
+    if cached is not None:
+        HISTORY.append(key, user_msg, { "role": "assistant", "content": cached })
+        if data.get("stream"):
+            return Response(sse({"delta": cached}) + sse({"done": True, "answer": cached, "prompt_tokens": 0, "cached": True}),
+                            mimetype="text/event-stream")
+        return jsonify(answer=cached, prompt_tokens=0, cached=True)
+
+    with timed("query_chunks"):
+        top_chunks = query_chunks(q_emb, top_k=5)
+    with timed("combined_faq"):
+        faq = combined_faq() if PROMPT_FAQ_TOKENS > 0 else ""
+    with timed("build_prompt"):
+        messages, prompt_tokens = build_prompt(persona, top_chunks, history, model, faq=faq)
+    METRICS.inc("prompt_tokens_budgeted", prompt_tokens)
+    headers = {"X-Prompt-Tokens": str(prompt_tokens)}
+
+    if data.get("stream"):
+        headers.update({"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        return Response(stream_answer(model, messages, temp, prompt_tokens, finish),
+                        mimetype="text/event-stream", headers=headers)
+
+    with timed("completion"):
+        resp = openai.chat.completions.create(model=model, messages=messages, temperature=temp)
+    record_usage(resp.usage)
     answer = resp.choices[0].message.content.strip()
-    history.append({ "role": "assistant", "content": answer })
-    CONV_HISTORY[sid()] = history
-    return jsonify(answer=answer)
+    finish(answer)
+    return jsonify(answer=answer, prompt_tokens=prompt_tokens), 200, headers
+
+def sse(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+def record_usage(usage):
+    if not usage: return
+    METRICS.inc("chat_prompt_tokens", usage.prompt_tokens)
+    METRICS.inc("chat_completion_tokens", usage.completion_tokens)
+
+def stream_answer(model, messages, temp, prompt_tokens, finish):
+    parts, start, first = [], time.perf_counter(), None
+    try:
+        for part in openai.chat.completions.create(model=model, messages=messages, temperature=temp, stream=True,
+                                                   stream_options={"include_usage": True}):
+            record_usage(part.usage)
+            delta = part.choices[0].delta.content if part.choices else None
+            if delta:
+                if first is None:
+                    first = time.perf_counter()
+                    METRICS.observe("completion_first_token", first - start)
+                parts.append(delta)
+                yield sse({"delta": delta})
+    except Exception as e:
+        print("ERROR:", e)
+        METRICS.inc("errors")
+        yield sse({"error": str(e)})
+        return
+    METRICS.observe("completion", time.perf_counter() - start)
+    answer = "".join(parts).strip()
+    finish(answer)
+    yield sse({"done": True, "answer": answer, "prompt_tokens": prompt_tokens})
+
+@app.cli.command("migrate-embeddings")
+@click.option("--dtype", default=EMBED_STORAGE, type=click.Choice(["float32", "float16", "int8"]))
+def migrate_embeddings(dtype):
+    """Rewrite pickled (or differently encoded) embeddings as raw `dtype` bytes."""
+    done = migrate_rows(dtype)
+    with ENG.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+    click.echo(f"Migrated {done} embeddings to {dtype}")
+
+@app.cli.command("compact-chunks")
+def compact_chunks():
+    """Delete chunk rows whose document is no longer indexed, backfill content hashes and VACUUM."""
+    live = {d["id"] for d in load_index()}
+    with ENG.begin() as conn:
+        orphans = [f for (f,) in conn.execute(text("SELECT DISTINCT file_id FROM chunks")) if f not in live]
+        removed = sum(conn.execute(delete(Chunk).where(Chunk.file_id == f)).rowcount for f in orphans)
+        rows = conn.execute(text("SELECT id, text FROM chunks WHERE hash IS NULL")).all()
+        if rows:
+            conn.execute(text("UPDATE chunks SET hash = :h WHERE id = :id"),
+                         [{"id": cid, "h": chunk_hash(t or "")} for cid, t in rows])
+    with ENG.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+    click.echo(f"Removed {removed} orphaned chunks from {len(orphans)} documents; hashed {len(rows)} chunks")
+
+@app.before_request
+def start_timer():
+    g.timings = {}
+    g.start   = time.perf_counter()
+
+@app.after_request
+def server_timing(resp):
+    if "start" not in g: return resp
+    total = time.perf_counter() - g.start
+    METRICS.observe(f"request:{request.endpoint}", total)
+    stages = [f"{k};dur={v * 1000:.2f}" for k, v in g.timings.items()]
+    resp.headers["Server-Timing"] = ", ".join(stages + [f"total;dur={total * 1000:.2f}"])
+    return resp
+
+@app.route("/admin/metrics", methods=["GET", "DELETE"])
+def metrics():
+    authorized = METRICS_TOKEN and request.headers.get("Authorization") == f"Bearer {METRICS_TOKEN}"
+    if not (is_admin() or authorized): return "forbidden", 403
+    if request.method == "DELETE":
+        METRICS.reset()
+        return "", 204
+    if request.args.get("format") == "prometheus":
+        return Response(METRICS.prometheus(), mimetype="text/plain; version=0.0.4")
+    return jsonify(METRICS.snapshot())
 
 @app.errorhandler(Exception)
 def handle_error(e):
     print("ERROR:", e)
+    METRICS.inc("errors")
     if isinstance(e, HTTPException):
         return jsonify(error=str(e)), e.code
     return jsonify(error=str(e)), 500
@@ -0,0 +1,106 @@
+"""Stub of the OpenAI embeddings and chat completions endpoints for offline benchmarks.
+
+Embeddings are deterministic unit vectors seeded from each input's hash; chat answers are
+a fixed sentence, optionally streamed token by token. Latencies are configurable so the
+app's own overhead can be separated from network time.
+
+    python bench/fake_openai.py --port 8765 --embed-ms 50 --chat-ms 300
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=x flask --app app run
+"""
+import argparse, hashlib, json, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+ANSWER = "Thanks for reaching out! Our support team is available 9-5 on weekdays."
+
+def fake_embedding(text, dim):
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vec  = np.random.default_rng(seed).standard_normal(dim).astype("float32")
+    return (vec / np.linalg.norm(vec)).tolist()
+
+class FakeOpenAI(BaseHTTPRequestHandler):
+    dim = 1536
+    embed_latency = 0.0
+    chat_latency  = 0.0
+    token_latency = 0.0
+    calls = {"embeddings": 0, "chat": 0}
+    lock  = threading.Lock()
+
+    def log_message(self, *a): pass
+
+    def send_json(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path.endswith("/embeddings"): return self.embeddings(body)
+        if self.path.endswith("/chat/completions"): return self.chat(body)
+        self.send_error(404)
+
+    def embeddings(self, body):
+        with self.lock: self.calls["embeddings"] += 1
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        time.sleep(self.embed_latency)
+        tokens = sum(len(t) // 4 + 1 for t in inputs)
+        self.send_json({
+            "object": "list", "model": body["model"],
+            "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(t, self.dim)}
+                     for i, t in enumerate(inputs)],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    def chat(self, body):
+        with self.lock: self.calls["chat"] += 1
+        prompt = sum(len(m["content"]) // 4 + 4 for m in body["messages"])
+        words  = ANSWER.split(" ")
+        usage  = {"prompt_tokens": prompt, "completion_tokens": len(words), "total_tokens": prompt + len(words)}
+        time.sleep(self.chat_latency)
+        if not body.get("stream"):
+            return self.send_json({
+                "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": ANSWER}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        base = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": body["model"]}
+        for i, w in enumerate(words):
+            delta = {"content": w if i == 0 else f" {w}"}
+            self.wfile.write(f"data: {json.dumps({**base, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]})}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(self.token_latency)
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self.wfile.write(f"data: {json.dumps({**base, 'choices': [], 'usage': usage})}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+
+def serve(port=0, dim=1536, embed_ms=0, chat_ms=0, token_ms=0):
+    """Start the stub on a daemon thread; returns the server (its port is server.server_port)."""
+    handler = type("Handler", (FakeOpenAI,), {
+        "dim": dim, "embed_latency": embed_ms / 1000, "chat_latency": chat_ms / 1000,
+        "token_latency": token_ms / 1000, "calls": {"embeddings": 0, "chat": 0},
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--dim", type=int, default=1536)
+    ap.add_argument("--embed-ms", type=float, default=0)
+    ap.add_argument("--chat-ms", type=float, default=0)
+    ap.add_argument("--token-ms", type=float, default=0)
+    args = ap.parse_args()
+    server = serve(args.port, args.dim, args.embed_ms, args.chat_ms, args.token_ms)
+    print(f"Fake OpenAI listening on http://127.0.0.1:{server.server_port}/v1")
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,150 @@
+"""Offline benchmark for document ingestion and /chat against a stubbed OpenAI server.
+
+    python bench/run.py --docs 20 --lines 2000 --chats 200 --concurrency 8 [--stream]
+
+Runs the app on a throwaway DATA_DIR, uploads a synthetic corpus through concurrent
+/admin/upload requests (one file each), then drives /chat concurrently and prints a JSON report: ingestion and chat throughput,
+client-side latency percentiles and the app's own /admin/metrics stage histograms.
+"""
+import argparse, json, logging, os, random, sys, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench.fake_openai import serve
+
+WORDS = ("account billing refund order shipping delivery password login invoice plan upgrade cancel "
+         "warranty return exchange support hours weekend holiday payment card address tracking").split()
+
+def synthetic_doc(rng, lines):
+    out = []
+    for i in range(lines):
+        q = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 9)))
+        a = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 20)))
+        out.append(f"Q{i}: How do I {q}? A: {a}.")
+    return "\n".join(out)
+
+def percentiles(values):
+    if not values: return {}
+    values = sorted(values)
+    pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+    return {"n": len(values), "p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99),
+            "max_ms": round(values[-1] * 1000, 2)}
+
+def login(base):
+    s = requests.Session()
+    s.post(f"{base}/admin/login", json={"password": os.environ["ADMIN_PASSWORD"]}).raise_for_status()
+    return s
+
+def ingest(base, docs, rows_per_chunk, concurrency):
+    local = threading.local()
+
+    def upload(item):
+        i, body = item
+        if not hasattr(local, "s"): local.s = login(base)
+        files = [("files", (f"doc{i}.txt", body.encode(), "text/plain"))]
+        return local.s.post(f"{base}/admin/upload", files=files, headers={"X-Chunk-Size": str(rows_per_chunk)}).json()
+
+    s = login(base)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        jobs = [j for batch in pool.map(upload, enumerate(docs)) for j in batch]
+    upload_s = time.perf_counter() - start
+    pending = {j["id"] for j in jobs}
+    results = []
+    while pending:
+        time.sleep(0.05)
+        for jid in list(pending):
+            job = s.get(f"{base}/admin/jobs/{jid}").json()
+            if job["status"] in ("done", "failed", "cancelled"):
+                pending.discard(jid)
+                results.append(job)
+    elapsed = time.perf_counter() - start
+    chunks  = sum(j["chunks_embedded"] for j in results)
+    return {"seconds": round(elapsed, 3), "upload_seconds": round(upload_s, 3), "docs": len(docs), "chunks": chunks,
+            "chunks_per_s": round(chunks / elapsed, 1),
+            "failed": [j for j in results if j["status"] != "done"]}
+
+def chat(base, questions, concurrency, stream):
+    local = threading.local()
+    latencies, first_tokens, server_timing = [], [], {}
+    lock = threading.Lock()
+
+    def one(question):
+        if not hasattr(local, "s"): local.s = requests.Session()
+        start = time.perf_counter()
+        resp = local.s.post(f"{base}/chat", json={"message": question, "stream": stream}, stream=stream)
+        first = None
+        if stream:
+            for _ in resp.iter_content(chunk_size=None):
+                if first is None: first = time.perf_counter() - start
+        else:
+            resp.json()
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if first is not None: first_tokens.append(first)
+            for part in resp.headers.get("Server-Timing", "").split(","):
+                if ";dur=" in part:
+                    name, dur = part.strip().split(";dur=")
+                    server_timing.setdefault(name, []).append(float(dur) / 1000)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, questions))
+    elapsed = time.perf_counter() - start
+    return {"seconds": round(elapsed, 3), "requests_per_s": round(len(questions) / elapsed, 1),
+            "latency": percentiles(latencies), "first_token": percentiles(first_tokens),
+            "server_timing": {k: percentiles(v) for k, v in sorted(server_timing.items())}}
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--docs", type=int, default=10)
+    ap.add_argument("--lines", type=int, default=1000, help="Q/A lines per synthetic document")
+    ap.add_argument("--chunk-size", type=int, default=50, help="lines per chunk (X-Chunk-Size)")
+    ap.add_argument("--chats", type=int, default=100)
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--upload-concurrency", type=int, default=4)
+    ap.add_argument("--stream", action="store_true")
+    ap.add_argument("--dim", type=int, default=1536)
+    ap.add_argument("--embed-ms", type=float, default=20)
+    ap.add_argument("--chat-ms", type=float, default=100)
+    ap.add_argument("--token-ms", type=float, default=5)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--output", help="also write the JSON report here")
+    args = ap.parse_args()
+
+    fake = serve(dim=args.dim, embed_ms=args.embed_ms, chat_ms=args.chat_ms, token_ms=args.token_ms)
+    data_dir = tempfile.mkdtemp(prefix="chatbot-bench-")
+    os.environ.update({
+        "DATA_DIR": data_dir, "OPENAI_API_KEY": "bench", "ADMIN_PASSWORD": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{fake.server_port}/v1",
+    })
+
+    import app
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    rng  = random.Random(args.seed)
+    docs = [synthetic_doc(rng, args.lines) for _ in range(args.docs)]
+    report = {"config": vars(args), "ingest": ingest(base, docs, args.chunk_size, args.upload_concurrency)}
+
+    lines = [l for d in docs for l in d.splitlines()]
+    questions = [rng.choice(lines).split(" A: ")[0].split(": ", 1)[1] for _ in range(args.chats)]
+    report["chat"]    = chat(base, questions, args.concurrency, args.stream)
+    report["metrics"] = login(base).get(f"{base}/admin/metrics").json()
+    report["openai_calls"] = dict(fake.RequestHandlerClass.calls)
+
+    server.shutdown()
+    fake.shutdown()
+    out = json.dumps(report, indent=2)
+    print(out)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: f.write(out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Page-level text extraction for uploaded documents.
+
+Kept apart from app.py so process-pool workers can import it without loading the
+Flask app, the database or the vector index.
+"""
+import csv, io
+from collections import deque
+
+from PyPDF2 import PdfReader
+from pdfminer.high_level import extract_pages as pdfminer_pages
+from pdfminer.layout import LTTextContainer
+import fitz
+import docx
+
+PROBE_PAGES         = 3
+PROBE_SPREAD        = 16
+MIN_PAGES_PER_TASK  = 2
+MAX_PAGES_PER_TASK  = 16
+TEXT_LINES_PER_PAGE = 1000
+DOCX_PARAS_PER_PAGE = 100
+SHEET_ROWS_PER_PAGE = 500
+
+def pdf_pages_fitz(path, start, stop):
+    with fitz.open(path) as doc:
+        return [doc[i].get_text() for i in range(start, stop)]
+
+def pdf_pages_pypdf(path, start, stop):
+    return [p.extract_text() or "" for p in PdfReader(path).pages[start:stop]]
+
+def pdf_pages_pdfminer(path, start, stop):
+    return ["".join(el.get_text() for el in layout if isinstance(el, LTTextContainer))
+            for layout in pdfminer_pages(path, page_numbers=range(start, stop))]
+
+PDF_BACKENDS = {"fitz": pdf_pages_fitz, "pypdf": pdf_pages_pypdf, "pdfminer": pdf_pages_pdfminer}
+
+def pdf_range(path, start, stop, backend):
+    return PDF_BACKENDS[backend](path, start, stop)
+
+def probe_pages(n):
+    """The first PROBE_PAGES pages plus about PROBE_SPREAD more spread over the document."""
+    return sorted(set(range(min(PROBE_PAGES, n))) | set(range(0, n, max(1, n // PROBE_SPREAD))))
+
+def choose_pdf_backend(path, max_pages=0):
+    """Pick the fastest backend that finds text on a sample of pages.
+
+    Returns (backend, page_count). The sample only decides the backend: when no backend
+    finds text on it (scanned cover pages, say), the fastest one that opens the file
+    still reads every page.
+    """
+    try:
+        with fitz.open(path) as doc: n, fast = len(doc), "fitz"
+    except Exception:
+        n, fast = len(PdfReader(path).pages), "pypdf"
+    if max_pages: n = min(n, max_pages)
+    sample = probe_pages(n)
+    for backend in (fast, "pdfminer"):
+        if any(pdf_range(path, p, p + 1, backend)[0].strip() for p in sample): return backend, n
+    return fast, n
+
+def iter_pdf(path, max_pages=0, pool=None, workers=1, inflight=4):
+    backend, n = choose_pdf_backend(path, max_pages)
+    pages_per_task = min(MAX_PAGES_PER_TASK, max(MIN_PAGES_PER_TASK, -(-n // max(1, workers))))
+    ranges = [(s, min(s + pages_per_task, n)) for s in range(0, n, pages_per_task)]
+    if pool is None or len(ranges) < 2:
+        for start, stop in ranges: yield from pdf_range(path, start, stop, backend)
+        return
+    pending = deque()
+    try:
+        for start, stop in ranges:
+            pending.append(pool.submit(pdf_range, path, start, stop, backend))
+            if len(pending) >= inflight: yield from pending.popleft().result()
+        while pending: yield from pending.popleft().result()
+    finally:
+        for fut in pending: fut.cancel()
+
+def iter_text(path):
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        lines = []
+        for line in f:
+            lines.append(line.rstrip("\r\n"))
+            if len(lines) == TEXT_LINES_PER_PAGE:
+                yield "\n".join(lines)
+                lines = []
+        if lines: yield "\n".join(lines)
+
+def iter_docx(path, max_paragraphs=0):
+    paras = docx.Document(path).paragraphs
+    if max_paragraphs: paras = paras[:max_paragraphs]
+    for i in range(0, len(paras), DOCX_PARAS_PER_PAGE):
+        yield "\n".join(p.text for p in paras[i:i+DOCX_PARAS_PER_PAGE])
+
+def sheet_rows(path, ext):
+    if ext == ".xlsx":
+        import openpyxl
+        wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            for ws in wb.worksheets: yield from ws.iter_rows(values_only=True)
+        finally:
+            wb.close()
+    else:
+        import xlrd
+        book = xlrd.open_workbook(path, on_demand=True)
+        for sheet in book.sheets():
+            for r in range(sheet.nrows): yield sheet.row_values(r)
+
+def iter_sheet(path, ext):
+    buf, rows = io.StringIO(), 0
+    out = csv.writer(buf, lineterminator="\n")
+    for row in sheet_rows(path, ext):
+        if all(v is None or v == "" for v in row): continue
+        out.writerow(["" if v is None else v for v in row])
+        rows += 1
+        if rows == SHEET_ROWS_PER_PAGE:
+            yield buf.getvalue().rstrip("\n")
+            buf.seek(0); buf.truncate()
+            rows = 0
+    if rows: yield buf.getvalue().rstrip("\n")
+
+def iter_pages(path, ext, max_pages=0, max_paragraphs=0, pool=None, workers=1, inflight=4):
+    """Yield a document's text a page at a time.
+
+    PDF pages are split into one range per worker, of MIN_PAGES_PER_TASK to
+    MAX_PAGES_PER_TASK pages, and run on `pool` if given; at most `inflight` ranges are
+    held at once, which bounds memory on long documents.
+    """
+    if ext == ".txt": return iter_text(path)
+    if ext == ".pdf": return iter_pdf(path, max_pages, pool, workers, inflight)
+    if ext == ".docx": return iter_docx(path, max_paragraphs)
+    if ext in (".xls", ".xlsx"): return iter_sheet(path, ext)
+    return iter(())
@@ -49,6 +49,40 @@ document.addEventListener("DOMContentLoaded", () => {
     div.innerHTML = `<strong>${role === "user" ? "You" : "Bot"}:</strong> ${text}`;
     chatBox.appendChild(div);
     chatBox.scrollTop = chatBox.scrollHeight;
+    return div;
+  }
+
+  function updateMsg(div, text) {
+    div.innerHTML = `<strong>Bot:</strong> ${text}`;
+    chatBox.scrollTop = chatBox.scrollHeight;
+  }
+
+  async function readStream(res, div) {
+    if (!res.headers.get("Content-Type").startsWith("text/event-stream")) {
+      const data = await res.json();
+      updateMsg(div, data.answer || `[error] ${data.error || ""}`);
+      return;
+    }
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let answer = "";
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      const events = buffer.split("\n\n");
+      buffer = events.pop();
+      for (const event of events) {
+        if (!event.startsWith("data: ")) continue;
+        const data = JSON.parse(event.slice(6));
+        if (data.delta) answer += data.delta;
+        if (data.done) answer = data.answer;
+        if (data.error) answer += ` [error] ${data.error}`;
+        spinner.style.display = "none";
+        updateMsg(div, answer);
+      }
+    }
   }
 
   function sendMessage() {
@@ -58,6 +92,7 @@ document.addEventListener("DOMContentLoaded", () => {
     msgBox.value = "";
     msgBox.focus();
     spinner.style.display = "inline-block";
+    const botDiv = appendMsg("bot", "");
 
     fetch("/chat", {
       method: "POST",
@@ -66,16 +101,16 @@ document.addEventListener("DOMContentLoaded", () => {
         message: text,
         model: "gpt-4o",
         temperature: parseFloat(document.getElementById("tempSlider").value),
-        persona: currentPersona
+        persona: currentPersona,
+        stream: true
       })
     })
-      .then(res => res.json())
-      .then(data => {
-        appendMsg("bot", data.answer || "[error]");
+      .then(res => readStream(res, botDiv))
+      .then(() => {
         spinner.style.display = "none";
       })
       .catch(err => {
-        appendMsg("bot", `[error] ${err.message}`);
+        updateMsg(botDiv, `[error] ${err.message}`);
         spinner.style.display = "none";
       });
   }
@@ -154,9 +189,11 @@ document.addEventListener("DOMContentLoaded", () => {
 
   // ───────────── DOCUMENTS ─────────────
   const faqList = document.getElementById("faqList");
+  const jobList = document.getElementById("jobList");
   const faqForm = document.getElementById("faqForm");
   const faqFiles = document.getElementById("faqFiles");
   const chunkSize = document.getElementById("chunkSize");
+  const replaceDocs = document.getElementById("replaceDocs");
   const dropBox = document.getElementById("dropBox");
   const sortDocsBtn = document.getElementById("sortDocs");
   const filterDocs = document.getElementById("filterDocs");
@@ -170,7 +207,7 @@ document.addEventListener("DOMContentLoaded", () => {
           const li = document.createElement("li");
           li.setAttribute("data-name", doc.name);
           const chunkStats = doc.chunks !== undefined
-            ? `<div class="chunk-info">Chunks: ${doc.chunks}, Skipped: ${doc.skipped}, Tokens: ${doc.token_est}, Cost: $${doc.cost_est}</div>`
+            ? `<div class="chunk-info">Chunks: ${doc.chunks}, Skipped: ${doc.skipped}, Reused: ${doc.reused || 0}, Tokens: ${doc.token_est}, Cost: $${doc.cost_est}</div>`
             : "";
           li.innerHTML = `
             <strong>${doc.name}</strong>
@@ -195,13 +232,41 @@ document.addEventListener("DOMContentLoaded", () => {
     for (const file of files) formData.append("files", file);
     fetch("/admin/upload", {
       method: "POST",
-      headers: { "X-Chunk-Size": chunkSize.value },
+      headers: { "X-Chunk-Size": chunkSize.value, "X-Replace-Existing": replaceDocs.checked ? "1" : "0" },
       body: formData
     })
       .then(res => res.json())
-      .then(() => loadFaqs());
+      .then(jobs => jobs.forEach(trackJob));
   };
 
+  function renderJob(li, job) {
+    const done = ["done", "failed", "cancelled"].includes(job.status);
+    li.innerHTML = `
+      <strong>${job.name}</strong>
+      <div class="chunk-info">${job.status}${job.error ? `: ${job.error}` : ""}${job.duplicate_of ? ` (already indexed as ${job.duplicate_of})` : ""} · Pages: ${job.pages}, Chunks: ${job.chunks_embedded}/${job.chunks}, Tokens: ${job.tokens}, Cost: $${job.cost}</div>
+      ${done ? "" : `<button class="delete">Cancel</button>`}
+    `;
+    if (!done) {
+      li.querySelector(".delete").onclick = () =>
+        fetch(`/admin/jobs/${job.id}`, { method: "DELETE" });
+    }
+    return done;
+  }
+
+  function trackJob(job) {
+    const li = document.createElement("li");
+    jobList.appendChild(li);
+    const poll = (job) => {
+      if (!renderJob(li, job)) {
+        setTimeout(() => fetch(`/admin/jobs/${job.id}`).then(res => res.json()).then(poll), 1000);
+        return;
+      }
+      if (job.status === "done") loadFaqs();
+      setTimeout(() => li.remove(), 5000);
+    };
+    poll(job);
+  }
+
   dropBox.onclick = () => faqFiles.click();
   dropBox.ondragover = (e) => {
     e.preventDefault();